@@ -0,0 +1,613 @@
+# src/app.py
+"""
+Local analysis service.
+
+Keeps a pool of warm worker processes (numpy/scipy/skimage and the loaders
+already imported) and an LRU cache of loaded datasets held in shared memory,
+so repeated requests on the same file skip both interpreter start-up and
+file loading.
+
+Run from the repository root:
+
+    python -m src.app --port 8765 --workers 4 --cache-mb 4096
+
+Endpoints (JSON bodies, bound to localhost only):
+    GET  /health       worker pool status (503 if a crashed pool had to be restarted)
+    GET  /cache        cached datasets and hit/miss counters
+    POST /metadata     {"path", "axes"}
+    POST /projection   {"path", "axes", "axis": "Z", "method": "max", "channel",
+                        "timepoint", "format"}
+    POST /bursts       {"path", "axes", "channel", "mip", "sigma_small", "sigma_large",
+                        "threshold_rel", "background", "background_kwargs", "backend"}
+    POST /evict        {"path"}
+
+/projection returns the array as .npy bytes (load with np.load(io.BytesIO(body)))
+unless "format" is "json".
+
+Datasets are served in the ImageData (Z, C, Y, X, T) convention and files
+that FileLoader does not return as 5-D are rejected. FileLoader maps 3-D
+TIFFs to (Z, 1, Y, X, 1), while burstanalysis.py reads the same files as
+(T, Y, X) time series. The optional "axes" field names what the five loaded
+axes really hold, as a permutation of "ZCYXT", and the data is reordered
+once at load time. For a 3-D TIFF time series pass "axes": "TCYXZ".
+Each "axes" value is cached as a separate dataset.
+"""
+import argparse
+import io
+import json
+import multiprocessing as mp
+import os
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.core.imaging import ImageData
+
+AXES = "ZCYXT"  # ImageData axis convention
+
+PROJECTIONS = {
+    "max": np.max,
+    "min": np.min,
+    "mean": np.mean,
+    "sum": np.sum,
+}
+
+BURST_PARAMS = (
+    "sigma_small",
+    "sigma_large",
+    "threshold_rel",
+    "background",
+    "background_kwargs",
+    "backend",
+)
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+
+_loader = None
+
+
+def _init_worker():
+    """
+    Import the analysis stack once per worker so requests only pay for the work.
+    """
+    global _loader
+    # Ctrl-C goes to the whole process group; shutdown is driven by the server.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import burstanalysis  # noqa: F401  (skimage, scipy, matplotlib)
+    from src.in_out.file_loader import FileLoader
+
+    _loader = FileLoader()
+
+
+def _check_axes(axes):
+    if not isinstance(axes, str) or sorted(axes.upper()) != sorted(AXES):
+        raise ValueError(f"'axes' must be a permutation of {AXES!r}, got {axes!r}")
+    return axes.upper()
+
+
+def _ready():
+    return os.getpid()
+
+
+def _load_into_shared_memory(path, axes=AXES):
+    """
+    Load `path` and copy its array into a new shared memory block, reordered
+    from the loaded `axes` to ZCYXT. Ownership of the block passes to the
+    parent's DatasetCache.
+    """
+    image = _loader.load(path)
+    data = image.get_array()
+    if data.ndim != len(AXES):
+        raise ValueError(f"Expected a 5-D {AXES} dataset from {path}, "
+                         f"got shape {data.shape}")
+    data = np.transpose(data, [axes.index(a) for a in AXES])
+
+    shm = shared_memory.SharedMemory(create=True, size=max(data.nbytes, 1))
+    try:
+        np.copyto(np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf), data)
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+
+    return {
+        "shm_name": shm.name,
+        "shape": tuple(data.shape),
+        "dtype": data.dtype.str,
+        "nbytes": int(data.nbytes),
+        "pixel_size_xyz": tuple(image.pixel_size_xyz),
+        "bit_depth": image.bit_depth,
+        "channel_names": list(image.channel_names),
+        "metadata": image.additional_metadata,
+    }
+
+
+def _run_on_dataset(descriptor, func, kwargs):
+    """
+    Attach to a cached dataset, wrap it in an ImageData backed by shared
+    memory (no copy) and return `func(image, **kwargs)`.
+    `func` must not return views into the image.
+    """
+    shm = shared_memory.SharedMemory(name=descriptor["shm_name"])
+    try:
+        data = np.ndarray(descriptor["shape"], dtype=np.dtype(descriptor["dtype"]), buffer=shm.buf)
+        data.flags.writeable = False
+        image = ImageData(
+            data,
+            pixel_size_xyz=descriptor["pixel_size_xyz"],
+            bit_depth=descriptor["bit_depth"],
+            channel_names=descriptor["channel_names"],
+            metadata=descriptor["metadata"],
+        )
+        return func(image, **kwargs)
+    finally:
+        data = image = None
+        try:
+            shm.close()
+        except BufferError:
+            # A traceback still references a view; the mapping goes with it.
+            pass
+
+
+def _project(image, axis="Z", method="max", channel=None, timepoint=None):
+    """
+    Project the dataset along the axes in `axis` (letters of "ZCYXT"),
+    optionally restricted to one channel and/or timepoint.
+    Returns (array, remaining_axes).
+    """
+    if not isinstance(axis, str):
+        raise ValueError(f"Projection axis must be a string of {AXES!r}, got {axis!r}")
+    axis = axis.upper()
+    if not axis or any(a not in AXES for a in axis):
+        raise ValueError(f"Projection axis must be made of {AXES!r}, got {axis!r}")
+    if method not in PROJECTIONS:
+        raise ValueError(f"Unknown projection method '{method}'. "
+                         f"Expected one of {sorted(PROJECTIONS)}")
+
+    index = [slice(None)] * len(AXES)
+    dropped = set(axis)
+    if channel is not None:
+        index[AXES.index("C")] = slice(int(channel), int(channel) + 1)
+        dropped.add("C")
+    if timepoint is not None:
+        index[AXES.index("T")] = slice(int(timepoint), int(timepoint) + 1)
+        dropped.add("T")
+    view = image.data[tuple(index)]
+    if view.size == 0:
+        raise ValueError(f"Channel {channel} / timepoint {timepoint} out of range "
+                         f"for shape {image.shape}")
+
+    reduce_axes = tuple(AXES.index(a) for a in AXES if a in dropped)
+    result = np.array(PROJECTIONS[method](view, axis=reduce_axes))
+
+    remaining = "".join(a for a in AXES if a not in dropped)
+    return result, remaining
+
+
+def _detect_bursts(image, channel=0, mip=False, **params):
+    """
+    Run `analyze_time_series` on one channel of the dataset.
+    (Z, Y, X, T) is reordered to (T, Z, Y, X), or (T, Y, X) for single
+    planes and when `mip` is set.
+    """
+    from burstanalysis import analyze_time_series
+
+    stack = np.moveaxis(image.data[:, int(channel)], -1, 0)  # (T, Z, Y, X)
+    if mip:
+        stack = stack.max(axis=1)
+    elif stack.shape[1] == 1:
+        stack = stack[:, 0]
+
+    burst_info = analyze_time_series(stack, **params)
+
+    return {
+        int(t): [[int(v) for v in coord] for coord in coords]
+        for t, coords in burst_info.items()
+    }
+
+
+# ---------------------------------------------------------------------------
+# Server side
+# ---------------------------------------------------------------------------
+
+class WorkerPool:
+    """
+    Warm pool of spawned worker processes that replaces itself when a
+    worker dies (e.g. the OOM killer during a large load).
+
+    Spawned (not forked) workers, because the server runs request threads.
+    Unlike multiprocessing.Pool, ProcessPoolExecutor still shuts down cleanly
+    when a signal to the process group has already killed its workers, but
+    once a worker crashes it is broken for good, so it is swapped for a
+    fresh one here.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.restarts = 0
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self):
+        executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        # The executor starts workers on demand; start them all now so the
+        # first requests do not pay for the imports.
+        for future in [executor.submit(_ready) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def _replace(self, broken):
+        with self._lock:
+            # Several requests can see the same broken executor; replace it once.
+            if self._executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._start()
+                self.restarts += 1
+
+    def run(self, func, *args, **kwargs):
+        """
+        Run `func` in a worker and return its result. If the pool is broken
+        it is replaced and `func` is retried once; a second crash raises
+        BrokenProcessPool.
+        """
+        executor = self._executor
+        try:
+            return executor.submit(func, *args, **kwargs).result()
+        except BrokenProcessPool:
+            self._replace(executor)
+        return self._executor.submit(func, *args, **kwargs).result()
+
+    def ping(self, timeout=1.0):
+        """
+        Return False (and replace the pool) if it is broken. Busy workers
+        that do not answer within `timeout` count as alive.
+        """
+        executor = self._executor
+        try:
+            executor.submit(_ready).result(timeout=timeout)
+        except BrokenProcessPool:
+            self._replace(executor)
+            return False
+        except FutureTimeoutError:
+            pass
+        return True
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _CacheEntry:
+    def __init__(self, key, descriptor):
+        self.key = key
+        self.descriptor = descriptor
+        self.users = 0
+        self.evicted = False
+
+
+class DatasetCache:
+    """
+    LRU cache of datasets loaded by the worker pool into shared memory.
+
+    Entries are keyed by (path, mtime, size, axes) so an edited file is
+    reloaded. Entries in use by a request are pinned and only released once
+    the request finishes, even if they are evicted in the meantime. The
+    budgets are enforced again when a request releases its entry, so a
+    dataset larger than `max_bytes` is still loaded and served, but it is
+    dropped as soon as its last request finishes.
+    """
+
+    def __init__(self, pool, max_bytes, max_items=16):
+        self.pool = pool
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(path, axes):
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        return (path, stat.st_mtime_ns, stat.st_size, axes)
+
+    def acquire(self, path, axes=AXES):
+        """
+        Return the pinned cache entry for `path` read with the given loaded
+        `axes`, loading it if needed. Every call must be paired with `release`.
+        """
+        key = self._key(path, _check_axes(axes))
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.users += 1
+                    self.hits += 1
+                    return entry
+                pending = self._loading.get(key)
+                if pending is None:
+                    pending = self._loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another request is loading the same file; wait and retry.
+            pending.wait()
+
+        try:
+            descriptor = self.pool.run(_load_into_shared_memory, key[0], key[3])
+        except Exception:
+            with self._lock:
+                del self._loading[key]
+            pending.set()
+            raise
+
+        entry = _CacheEntry(key, descriptor)
+        entry.users = 1
+        with self._lock:
+            # Older versions of the same file are no longer reachable.
+            for other in list(self._entries.values()):
+                if other.key[0] == key[0] and other.key[3] == key[3]:
+                    self._remove(other)
+            self._entries[key] = entry
+            del self._loading[key]
+            self._evict_over_budget()
+        pending.set()
+        return entry
+
+    def release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            if entry.users == 0:
+                if entry.evicted:
+                    _unlink(entry.descriptor["shm_name"])
+                else:
+                    self._evict_over_budget()
+
+    def evict(self, path):
+        """
+        Drop every cached version of `path`. Returns the number of entries removed.
+        """
+        path = os.path.realpath(path)
+        with self._lock:
+            matching = [e for e in self._entries.values() if e.key[0] == path]
+            for entry in matching:
+                self._remove(entry)
+        return len(matching)
+
+    def info(self):
+        with self._lock:
+            return {
+                "entries": [
+                    {
+                        "path": e.key[0],
+                        "axes": e.key[3],
+                        "shape": e.descriptor["shape"],
+                        "dtype": e.descriptor["dtype"],
+                        "nbytes": e.descriptor["nbytes"],
+                        "in_use": e.users,
+                    }
+                    for e in self._entries.values()
+                ],
+                "total_bytes": self._total_bytes(),
+                "max_bytes": self.max_bytes,
+                "max_items": self.max_items,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self):
+        with self._lock:
+            for entry in list(self._entries.values()):
+                entry.users = 0
+                self._remove(entry)
+
+    def _total_bytes(self):
+        return sum(e.descriptor["nbytes"] for e in self._entries.values())
+
+    def _evict_over_budget(self):
+        # Oldest first; pinned entries are skipped here and handled again
+        # by `release` once their last request finishes.
+        for entry in list(self._entries.values()):
+            if self._total_bytes() <= self.max_bytes and len(self._entries) <= self.max_items:
+                break
+            if entry.users == 0:
+                self._remove(entry)
+
+    def _remove(self, entry):
+        del self._entries[entry.key]
+        entry.evicted = True
+        if entry.users == 0:
+            _unlink(entry.descriptor["shm_name"])
+
+
+def _unlink(shm_name):
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    server_version = "BoptLab/0.1"
+
+    def do_GET(self):
+        if self.path == "/health":
+            pool = self.server.pool
+            alive = pool.ping()
+            self._send_json({
+                "status": "ok" if alive else "broken",
+                "workers": pool.workers,
+                "restarts": pool.restarts,
+            }, status=200 if alive else 503)
+        elif self.path == "/cache":
+            self._send_json(self.server.cache.info())
+        else:
+            self._send_json({"error": f"Unknown endpoint {self.path}"}, status=404)
+
+    def do_POST(self):
+        routes = {
+            "/metadata": self._metadata,
+            "/projection": self._projection,
+            "/bursts": self._bursts,
+            "/evict": self._evict,
+        }
+        route = routes.get(self.path)
+        if route is None:
+            self._send_json({"error": f"Unknown endpoint {self.path}"}, status=404)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if "path" not in body:
+                raise ValueError("Request body must contain 'path'")
+            route(body)
+        except FileNotFoundError as exc:
+            self._send_json({"error": str(exc)}, status=404)
+        except BrokenProcessPool as exc:
+            self._send_json({"error": f"Worker crashed: {exc}"}, status=503)
+        except (ValueError, KeyError, IndexError, TypeError) as exc:
+            self._send_json({"error": f"{type(exc).__name__}: {exc}"}, status=400)
+        except Exception as exc:
+            self._send_json({"error": f"{type(exc).__name__}: {exc}"}, status=500)
+
+    def _metadata(self, body):
+        cache = self.server.cache
+        entry = cache.acquire(body["path"], body.get("axes", AXES))
+        try:
+            d = entry.descriptor
+            payload = {
+                "path": entry.key[0],
+                "axes": AXES,
+                "shape": d["shape"],
+                "dtype": d["dtype"],
+                "pixel_size_xyz": d["pixel_size_xyz"],
+                "bit_depth": d["bit_depth"],
+                "channel_names": d["channel_names"],
+                "metadata": d["metadata"],
+            }
+        finally:
+            cache.release(entry)
+        self._send_json(payload)
+
+    def _projection(self, body):
+        kwargs = {k: body[k] for k in ("axis", "method", "channel", "timepoint") if k in body}
+        result, axes = self._run(body, _project, kwargs)
+
+        if body.get("format", "npy") == "json":
+            self._send_json({"axes": axes, "shape": result.shape,
+                             "dtype": result.dtype.str, "data": result.tolist()})
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, result, allow_pickle=False)
+        self._send_bytes(buffer.getvalue(), "application/octet-stream",
+                         extra_headers={"X-Axes": axes})
+
+    def _bursts(self, body):
+        kwargs = {k: body[k] for k in BURST_PARAMS + ("channel", "mip") if k in body}
+        bursts = self._run(body, _detect_bursts, kwargs)
+        self._send_json({
+            "bursts": bursts,
+            "n_spots": sum(len(coords) for coords in bursts.values()),
+        })
+
+    def _evict(self, body):
+        self._send_json({"evicted": self.server.cache.evict(body["path"])})
+
+    def _run(self, body, func, kwargs):
+        cache = self.server.cache
+        entry = cache.acquire(body["path"], body.get("axes", AXES))
+        try:
+            return self.server.pool.run(_run_on_dataset, entry.descriptor, func, kwargs)
+        finally:
+            cache.release(entry)
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, default=_json_default).encode("utf-8")
+        self._send_bytes(body, "application/json", status=status)
+
+    def _send_bytes(self, body, content_type, status=200, extra_headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class AnalysisServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers=4, cache_bytes=4 << 30, max_datasets=16):
+        self.pool = WorkerPool(workers)
+        self.cache = DatasetCache(self.pool, cache_bytes, max_datasets)
+        super().__init__(address, AnalysisRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.cache.close()
+        self.pool.shutdown()
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local BoptLab analysis service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--cache-mb", type=int, default=4096,
+                        help="Shared memory budget for cached datasets")
+    parser.add_argument("--max-datasets", type=int, default=16)
+    args = parser.parse_args()
+
+    server = AnalysisServer(
+        (args.host, args.port),
+        workers=args.workers,
+        cache_bytes=args.cache_mb << 20,
+        max_datasets=args.max_datasets,
+    )
+    # Shut down on SIGTERM (kill, systemd, timeout) the same way as on Ctrl-C.
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,534 @@
+# src/core/processing.py
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import ndimage
+
+
+def _float32_buffer(shape, buf=None, name="Output"):
+    """
+    Return `buf` after checking it is a float32 array of `shape`, or a new one.
+    """
+    if buf is None:
+        return np.empty(shape, dtype=np.float32)
+    if buf.shape != tuple(shape) or buf.dtype != np.float32:
+        raise ValueError(f"{name} buffer must be float32 with shape {tuple(shape)}, "
+                         f"got {buf.dtype} {buf.shape}")
+    return buf
+
+
+def _as_float32_stack(stack, out=None):
+    """
+    Return a float32 working copy of `stack`, reusing `out` when it is given.
+    """
+    out = _float32_buffer(stack.shape, out)
+    if out is not stack:
+        np.copyto(out, stack, casting="unsafe")
+    return out
+
+
+def tophat_background(stack, radius=15, spatial_axes=(-2, -1), out=None, scratch=None):
+    """
+    Estimate the background of each frame with a grey opening
+    (minimum filter followed by maximum filter) over a square/cubic
+    structuring element of side 2 * radius + 1.
+
+    The flat rectangular element is separable, so the opening is done as
+    a sequence of 1D min/max passes along `spatial_axes`. Each pass is
+    O(1) per pixel with respect to the radius, unlike a rolling ball.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        Image stack, e.g. (T, Y, X) or (T, Z, Y, X).
+    radius : int
+        Half-width of the structuring element in pixels. Should be larger
+        than the radius of the spots to keep.
+    spatial_axes : tuple of int
+        Axes the element extends over. Other axes are treated independently.
+    out : np.ndarray or None
+        Optional preallocated float32 array of the same shape as `stack`.
+    scratch : np.ndarray or None
+        Optional preallocated float32 work array of the same shape as `stack`,
+        so repeated calls do not allocate.
+
+    Returns
+    -------
+    background : np.ndarray
+        float32 background estimate, same shape as `stack`.
+    """
+    size = 2 * int(radius) + 1
+    out = _as_float32_stack(stack, out)
+    scratch = _float32_buffer(stack.shape, scratch, name="Scratch")
+
+    # Opening = erosion then dilation; ping-pong between the two buffers.
+    src, dst = out, scratch
+    for axis in spatial_axes:
+        ndimage.minimum_filter1d(src, size, axis=axis, output=dst, mode="nearest")
+        src, dst = dst, src
+    for axis in spatial_axes:
+        ndimage.maximum_filter1d(src, size, axis=axis, output=dst, mode="nearest")
+        src, dst = dst, src
+
+    if src is not out:
+        np.copyto(out, src)
+    return out
+
+
+def _block_mean_axis(arr, axis, factor):
+    """
+    Average `arr` over consecutive blocks of `factor` samples along `axis`.
+    A shorter trailing block is averaged over its own length.
+    """
+    n = arr.shape[axis]
+    n_full = n // factor
+    arr = np.moveaxis(arr, axis, 0)
+    parts = []
+    if n_full:
+        full = arr[:n_full * factor].reshape((n_full, factor) + arr.shape[1:])
+        parts.append(full.mean(axis=1, dtype=np.float32))
+    if n_full * factor < n:
+        parts.append(arr[n_full * factor:].mean(axis=0, dtype=np.float32, keepdims=True))
+    return np.moveaxis(np.concatenate(parts), 0, axis)
+
+
+def _linear_upsample_axis(src, axis, length, factor, out=None):
+    """
+    Linearly interpolate `src` along `axis` from block centres back to
+    `length` samples, writing into `out` when it is given.
+    """
+    m = src.shape[axis]
+    pos = (np.arange(length) + 0.5) / factor - 0.5
+    np.clip(pos, 0, m - 1, out=pos)
+    i0 = np.floor(pos).astype(np.intp)
+    i1 = np.minimum(i0 + 1, m - 1)
+    view = [1] * src.ndim
+    view[axis] = length
+    weight = (pos - i0).astype(np.float32).reshape(view)
+
+    lower = np.take(src, i0, axis=axis, out=out)
+    upper = np.take(src, i1, axis=axis)
+    upper -= lower
+    upper *= weight
+    lower += upper
+    return lower
+
+
+def downsampled_background(stack, factor=8, radius=15, smooth_sigma=1.0,
+                           spatial_axes=(-2, -1), out=None):
+    """
+    Estimate a smooth background on a block-averaged copy of the stack and
+    interpolate it back to full resolution.
+
+    The opening is run on an image `factor` times smaller per axis, which
+    makes large radii cheap. Suited to slowly varying illumination.
+    Only `out` and arrays about `factor` times smaller than the stack are
+    allocated; the last upsampling pass writes straight into `out`.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        Image stack, e.g. (T, Y, X) or (T, Z, Y, X).
+    factor : int
+        Downsampling factor along each of `spatial_axes`.
+    radius : int
+        Half-width of the opening element in full-resolution pixels.
+    smooth_sigma : float
+        Gaussian sigma (in downsampled pixels) applied after the opening to
+        remove blocky artifacts. 0 disables smoothing.
+    spatial_axes : tuple of int
+        Axes to downsample. Other axes are treated independently.
+    out : np.ndarray or None
+        Optional preallocated float32 array of the same shape as `stack`.
+
+    Returns
+    -------
+    background : np.ndarray
+        float32 background estimate, same shape as `stack`.
+    """
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError(f"Downsampling factor must be >= 1, got {factor}")
+    out = _float32_buffer(stack.shape, out)
+
+    ndim = stack.ndim
+    axes = sorted(ax % ndim for ax in spatial_axes)
+
+    small = stack
+    for ax in axes:
+        small = _block_mean_axis(small, ax, factor)
+
+    small_radius = max(1, int(round(radius / factor)))
+    small_bg = tophat_background(small, radius=small_radius, spatial_axes=axes)
+    if smooth_sigma > 0:
+        sigma = [smooth_sigma if ax in axes else 0 for ax in range(ndim)]
+        ndimage.gaussian_filter(small_bg, sigma, output=small_bg, mode="nearest")
+
+    # All but the last axis are upsampled into intermediates that are still
+    # reduced along the last axis.
+    for ax in axes[:-1]:
+        small_bg = _linear_upsample_axis(small_bg, ax, stack.shape[ax], factor)
+
+    # The last pass fills `out` one slab at a time along a leading axis to
+    # keep its temporary at slab size.
+    last = axes[-1]
+    slab_axis = next((ax for ax in range(ndim) if ax != last), None)
+    if slab_axis is None:
+        _linear_upsample_axis(small_bg, last, stack.shape[last], factor, out=out)
+        return out
+    inner_axis = last - (last > slab_axis)
+    index = [slice(None)] * ndim
+    for i in range(stack.shape[slab_axis]):
+        index[slab_axis] = i
+        _linear_upsample_axis(small_bg[tuple(index)], inner_axis, stack.shape[last],
+                              factor, out=out[tuple(index)])
+    return out
+
+
+def temporal_median_background(stack, window=15, time_axis=0, out=None):
+    """
+    Estimate the background of each frame as the per-pixel median over a
+    sliding window of `window` frames centred on it (clamped at the ends).
+
+    The window is kept as a per-pixel sorted buffer. Moving it by one frame
+    removes the outgoing value and inserts the incoming one in O(window)
+    per pixel instead of re-sorting the whole window.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        Image stack with time along `time_axis`.
+    window : int
+        Number of frames in the sliding window.
+    time_axis : int
+        Axis holding time.
+    out : np.ndarray or None
+        Optional preallocated float32 array of the same shape as `stack`.
+
+    Returns
+    -------
+    background : np.ndarray
+        float32 background estimate, same shape as `stack`.
+    """
+    out = _float32_buffer(stack.shape, out)
+    frames = np.moveaxis(stack, time_axis, 0)
+    bg = np.moveaxis(out, time_axis, 0)
+    T = frames.shape[0]
+    w = max(1, min(int(window), T))
+    half = w // 2
+    lo, hi = (w - 1) // 2, w // 2
+
+    frame_shape = frames.shape[1:]
+    n_pix = int(np.prod(frame_shape))
+
+    # (w, n_pix) sorted window and work buffers reused on every step
+    window_buf = np.sort(frames[:w].reshape(w, n_pix).astype(np.float32), axis=0)
+    next_buf = np.empty_like(window_buf)
+    src_idx = np.empty(window_buf.shape, dtype=np.intp)
+    mask = np.empty(window_buf.shape, dtype=bool)
+    rank = np.arange(w)[:, np.newaxis]
+    column = np.arange(n_pix)
+    incoming = np.empty(n_pix, dtype=np.float32)
+    outgoing = np.empty(n_pix, dtype=np.float32)
+    removed = np.empty(n_pix, dtype=np.intp)
+    insert = np.empty(n_pix, dtype=np.intp)
+    pix_mask = np.empty(n_pix, dtype=bool)
+    median = np.empty(n_pix, dtype=np.float32)
+
+    start = 0
+    for t in range(T):
+        target = min(max(t - half, 0), T - w)
+        while start < target:
+            outgoing[:] = frames[start].reshape(n_pix)
+            incoming[:] = frames[start + w].reshape(n_pix)
+
+            # Slot of the outgoing value; np.argmax returns the first match.
+            np.equal(window_buf, outgoing, out=mask)
+            np.argmax(mask, axis=0, out=removed)
+            # Insertion rank among the w - 1 remaining values.
+            np.less(window_buf, incoming, out=mask)
+            np.sum(mask, axis=0, out=insert)
+            np.less(removed, insert, out=pix_mask)
+            np.subtract(insert, pix_mask, out=insert)
+
+            # Row k of the new window is the incoming value at `insert`,
+            # otherwise row k (or k - 1 past the insertion) of the old window
+            # with the removed slot skipped.
+            np.copyto(src_idx, rank)
+            np.greater(rank, insert, out=mask)
+            np.subtract(src_idx, mask, out=src_idx)
+            np.greater_equal(src_idx, removed, out=mask)
+            np.add(src_idx, mask, out=src_idx)
+
+            # Gather through flat indices straight into next_buf. Only the
+            # row at `insert` can point past the window; mode="clip" keeps
+            # it in range and it is overwritten below.
+            np.multiply(src_idx, n_pix, out=src_idx)
+            np.add(src_idx, column, out=src_idx)
+            np.take(window_buf.reshape(-1), src_idx, out=next_buf, mode="clip")
+            np.equal(rank, insert, out=mask)
+            np.copyto(next_buf, incoming, where=mask)
+            window_buf, next_buf = next_buf, window_buf
+            start += 1
+
+        if lo != hi:
+            np.add(window_buf[lo], window_buf[hi], out=median)
+            median *= 0.5
+        else:
+            median[:] = window_buf[lo]
+        bg[t] = median.reshape(frame_shape)
+
+    return out
+
+
+BACKGROUND_METHODS = {
+    "tophat": tophat_background,
+    "downsample": downsampled_background,
+    "temporal_median": temporal_median_background,
+}
+
+
+def subtract_background(stack, method="tophat", clip_negative=True, out=None, **kwargs):
+    """
+    Remove background from an image stack before burst detection.
+
+    Parameters
+    ----------
+    stack : np.ndarray
+        Image stack as passed to `analyze_time_series`, i.e. (T, Y, X) or
+        (T, Z, Y, X).
+    method : str
+        One of "tophat", "downsample" or "temporal_median".
+    clip_negative : bool
+        Set negative values of the result to zero.
+    out : np.ndarray or None
+        Optional preallocated float32 array of the same shape as `stack`.
+        It must not be `stack` itself.
+    **kwargs
+        Passed to the background estimator of the chosen method, e.g.
+        `scratch` to reuse the top-hat work buffer across calls.
+
+    Returns
+    -------
+    corrected : np.ndarray
+        float32 stack with the background subtracted.
+    """
+    if method not in BACKGROUND_METHODS:
+        raise ValueError(f"Unknown background method '{method}'. "
+                         f"Expected one of {sorted(BACKGROUND_METHODS)}")
+    if out is not None and np.shares_memory(out, stack):
+        raise ValueError("Output buffer must not overlap the input stack")
+
+    # The background is estimated directly into `out` and the input is then
+    # subtracted from it in place, so no extra stack-sized array is needed.
+    out = BACKGROUND_METHODS[method](stack, out=out, **kwargs)
+    np.subtract(stack, out, out=out)
+    if clip_negative:
+        np.maximum(out, 0, out=out)
+    return out
+
+
+def _sigmas_in_pixels(sigma, ndim, pixel_size=None):
+    """
+    Broadcast `sigma` to one value per axis and convert it from physical
+    units to pixels when `pixel_size` is given.
+    """
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (ndim,))
+    if pixel_size is not None:
+        sigma = sigma / np.broadcast_to(np.asarray(pixel_size, dtype=float), (ndim,))
+    return tuple(float(s) for s in sigma)
+
+
+class FFTBandpass:
+    """
+    Difference-of-Gaussians computed as a single band-pass filter in the
+    frequency domain.
+
+    The transfer function and the padded real-space input buffer depend only
+    on the frame shape and the sigmas, so one instance is built per
+    configuration (see `get_fft_bandpass`) and reused for every frame.
+    The spectrum and the inverse transform are still allocated by scipy on
+    each call. Its cost does not depend on the sigmas, which makes it faster
+    than spatial convolution for large `sigma_large` and for 3D volumes.
+
+    Not thread-safe: every call writes into the shared input buffer, so an
+    instance must not be used from several threads at once.
+
+    Frames are padded by edge replication over `truncate * sigma_large`
+    pixels to match the "nearest" boundary handling of the spatial filter
+    and to keep the circular FFT from wrapping opposite borders together.
+    """
+
+    def __init__(self, shape, sigma_small, sigma_large, truncate=4.0):
+        """
+        shape: shape of the frames to filter (2D or 3D)
+        sigma_small, sigma_large: per-axis sigmas in pixels
+        truncate: padding width in units of sigma_large
+        """
+        self.shape = tuple(shape)
+        self.sigma_small = tuple(sigma_small)
+        self.sigma_large = tuple(sigma_large)
+
+        self.pad = tuple(int(np.ceil(truncate * s)) for s in self.sigma_large)
+        self.padded_shape = tuple(
+            sp_fft.next_fast_len(n + 2 * p, real=True) for n, p in zip(self.shape, self.pad)
+        )
+        self.inner = tuple(slice(p, p + n) for n, p in zip(self.shape, self.pad))
+
+        self.workspace = np.empty(self.padded_shape, dtype=np.float32)
+        self.transfer = self._transfer_function()
+
+    def _transfer_function(self):
+        # Frequencies in cycles/pixel on the rfftn grid: full axes first,
+        # the last axis halved.
+        ndim = len(self.padded_shape)
+        freqs = [sp_fft.fftfreq(n) for n in self.padded_shape[:-1]]
+        freqs.append(sp_fft.rfftfreq(self.padded_shape[-1]))
+
+        exp_small = np.zeros([len(f) for f in freqs], dtype=np.float64)
+        exp_large = np.zeros_like(exp_small)
+        for axis, f in enumerate(freqs):
+            view = [1] * ndim
+            view[axis] = len(f)
+            f2 = (2 * np.pi ** 2) * f.reshape(view) ** 2
+            exp_small = exp_small - self.sigma_small[axis] ** 2 * f2
+            exp_large = exp_large - self.sigma_large[axis] ** 2 * f2
+
+        return (np.exp(exp_small) - np.exp(exp_large)).astype(np.float32)
+
+    def _fill_workspace(self, image):
+        ws = self.workspace
+        ws[self.inner] = image
+        # Replicate the edges axis by axis, like np.pad(mode="edge").
+        for axis, (n, p) in enumerate(zip(self.shape, self.pad)):
+            lead = (slice(None),) * axis
+            ws[lead + (slice(0, p),)] = ws[lead + (slice(p, p + 1),)]
+            ws[lead + (slice(p + n, None),)] = ws[lead + (slice(p + n - 1, p + n),)]
+
+    def __call__(self, image, out=None):
+        if image.shape != self.shape:
+            raise ValueError(f"Expected a frame of shape {self.shape}, got {image.shape}")
+        if out is None:
+            out = np.empty(self.shape, dtype=np.float32)
+
+        self._fill_workspace(image)
+        spectrum = sp_fft.rfftn(self.workspace)
+        spectrum *= self.transfer
+        filtered = sp_fft.irfftn(spectrum, s=self.padded_shape, overwrite_x=True)
+        out[...] = filtered[self.inner]
+        return out
+
+
+@lru_cache(maxsize=4)
+def get_fft_bandpass(shape, sigma_small, sigma_large):
+    """
+    Return the cached `FFTBandpass` for a frame shape and per-axis pixel sigmas.
+
+    Each instance holds a padded frame and a transfer function (tens of MB
+    for large volumes), so only the few most recent configurations are kept.
+    """
+    return FFTBandpass(shape, sigma_small, sigma_large)
+
+
+def _dog_spatial(image, sigma_small, sigma_large, out=None):
+    if out is None:
+        out = np.empty(image.shape, dtype=np.float32)
+    blurred_large = np.empty(image.shape, dtype=np.float32)
+    ndimage.gaussian_filter(image, sigma_small, output=out, mode="nearest")
+    ndimage.gaussian_filter(image, sigma_large, output=blurred_large, mode="nearest")
+    np.subtract(out, blurred_large, out=out)
+    return out
+
+
+def _dog_fft(image, sigma_small, sigma_large, out=None):
+    return get_fft_bandpass(image.shape, sigma_small, sigma_large)(image, out=out)
+
+
+DOG_BACKENDS = {
+    "spatial": _dog_spatial,
+    "fft": _dog_fft,
+}
+
+# (shape, sigma_small, sigma_large) -> fastest backend measured for it,
+# least recently used first
+_dog_backend_choice = OrderedDict()
+_DOG_CHOICE_MAXSIZE = 64
+_DOG_TIMING_RUNS = 3
+
+
+def _measure_dog_backend(image, sigma_small, sigma_large):
+    """
+    Time each backend on `image` and remember the faster one for this
+    shape and sigmas. Returns the chosen backend and its result.
+    """
+    timings = {}
+    results = {}
+    for name, func in DOG_BACKENDS.items():
+        # The untimed first call builds the transfer function and lets scipy
+        # set up its FFT plan, so only steady-state cost is compared.
+        results[name] = func(image, sigma_small, sigma_large)
+        best_time = float("inf")
+        for _ in range(_DOG_TIMING_RUNS):
+            start = time.perf_counter()
+            func(image, sigma_small, sigma_large, out=results[name])
+            best_time = min(best_time, time.perf_counter() - start)
+        timings[name] = best_time
+
+    best = min(timings, key=timings.get)
+    _dog_backend_choice[(image.shape, sigma_small, sigma_large)] = best
+    while len(_dog_backend_choice) > _DOG_CHOICE_MAXSIZE:
+        _dog_backend_choice.popitem(last=False)
+    return best, results[best]
+
+
+def difference_of_gaussians(image, sigma_small, sigma_large, pixel_size=None,
+                            backend="auto", out=None):
+    """
+    Band-pass filter a 2D or 3D frame with a Difference-of-Gaussians.
+
+    Parameters
+    ----------
+    image : np.ndarray
+        2D or 3D frame.
+    sigma_small, sigma_large : float or sequence of float
+        Gaussian sigmas, one value or one per axis. In pixels, or in the
+        units of `pixel_size` when it is given.
+    pixel_size : float or sequence of float or None
+        Pixel size per axis, e.g. (z, y, x) in micrometers for a volume.
+    backend : str
+        "spatial" for separable Gaussian convolution, "fft" for a cached
+        frequency-domain band-pass, or "auto" to time both on the first
+        frame of a given shape and sigmas and use the faster from then on.
+        The FFT band-pass uses the continuous Gaussian transfer function and
+        edge padding, so it differs slightly from the spatial result and
+        can shift near-tie peaks by a pixel. "auto" may therefore give
+        different detections in different processes.
+    out : np.ndarray or None
+        Optional preallocated float32 array with the shape of `image`.
+
+    Returns
+    -------
+    dog : np.ndarray
+        float32 filtered frame.
+    """
+    sigma_small = _sigmas_in_pixels(sigma_small, image.ndim, pixel_size)
+    sigma_large = _sigmas_in_pixels(sigma_large, image.ndim, pixel_size)
+
+    if backend == "auto":
+        key = (image.shape, sigma_small, sigma_large)
+        if key not in _dog_backend_choice:
+            _, dog = _measure_dog_backend(image, sigma_small, sigma_large)
+            if out is None:
+                return dog
+            out[...] = dog
+            return out
+        _dog_backend_choice.move_to_end(key)
+        backend = _dog_backend_choice[key]
+
+    if backend not in DOG_BACKENDS:
+        raise ValueError(f"Unknown DoG backend '{backend}'. "
+                         f"Expected 'auto' or one of {sorted(DOG_BACKENDS)}")
+    return DOG_BACKENDS[backend](image, sigma_small, sigma_large, out=out)